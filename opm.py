@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
+import csv
+import fcntl
+import hashlib
 import json
 import logging
 import os
 import re
+import stat
 import subprocess
 import sys
+import tempfile
+import time
 import xml.etree.ElementTree as ElementTree
 
 
@@ -107,6 +114,7 @@ class VmInfo:
         #     <OTHER_A>0</OTHER_A>
         #   </PERMISSIONS>
         #   <STATE>8</STATE>
+        #   <LCM_STATE>0</LCM_STATE>
         #   <TEMPLATE>
         #     <CPU><![CDATA[0.1]]></CPU>
         #     <DISK> *many*
@@ -188,13 +196,18 @@ class VmInfo:
         value = vm_elem.find("STATE")
         if value is not None:
             vm.state = int(value.text)
+        # extract lcm state
+        value = vm_elem.find("LCM_STATE")
+        if value is not None:
+            vm.lcm_state = int(value.text)
         # return constructed
         logging.debug("Parsed: {0}".format(vm))
         return vm
 
-    def __init__(self, name=None, cpu=None, vcpu=None, mem_mb=None, networks=None, disks=None, one_template=None, group=None, permissions=None, vm_id=None, state=None):
+    def __init__(self, name=None, cpu=None, vcpu=None, mem_mb=None, networks=None, disks=None, one_template=None, group=None, permissions=None, vm_id=None, state=None, vm_class=None, lcm_state=None):
         # configuration
         self.name = name
+        self.vm_class = vm_class
         self.cpu = cpu
         self.vcpu = vcpu
         self.mem_mb = mem_mb
@@ -206,9 +219,10 @@ class VmInfo:
         # state
         self.id = vm_id
         self.state = state
+        self.lcm_state = lcm_state
 
     def __repr__(self):
-        return "VmInfo(name={0}, cpu={1}, vcpu={2}, mem_mb={3}, networks={4}, disks={5}, one_template={6}, group={7}, permissions={8}, id={9}, state={10})".format(self.name, self.cpu, self.vcpu, self.mem_mb, self.networks, self.disks, self.one_template, self.group, self.permissions, self.id, self.state)
+        return "VmInfo(name={0}, cpu={1}, vcpu={2}, mem_mb={3}, networks={4}, disks={5}, one_template={6}, group={7}, permissions={8}, id={9}, state={10}, vm_class={11}, lcm_state={12})".format(self.name, self.cpu, self.vcpu, self.mem_mb, self.networks, self.disks, self.one_template, self.group, self.permissions, self.id, self.state, self.vm_class, self.lcm_state)
 
     def pretty_tostring(self):
         return "name: {0}\n\tgroup: {1}\n\tpermissions: {2}\n\tcpu: {3}\n\tvcpu: {4}\n\tmem_mb: {5}\n\tone_template: {6}\n\tnetworks: {7}{8}\n\tdisks: {9}{10}".format(
@@ -224,6 +238,19 @@ class VmInfo:
             len(self.disks),
             "".join([ "\n\t\t{0}".format(disk.pretty_tostring()) for disk in self.disks]))
 
+    def config_record(self):
+        return {
+            'class': self.vm_class,
+            'group': self.group,
+            'permissions': self.permissions,
+            'cpu_percent': self.cpu,
+            'vcpu_count': self.vcpu,
+            'mem_mb': self.mem_mb,
+            'one_template': self.one_template,
+            'networks': self.networks,
+            'disks': self.disks,
+        }
+
     def override_config(self, params):
         # logging.debug("Before override vm : {0}".format(self))
         # logging.debug("Overriding vm with : {0}".format(params))
@@ -298,12 +325,146 @@ class VmInfo:
         return differences
 
 
+class Snapshot:
+
+    ENV_ONEAUTH="ONE_AUTH"
+    DEFAULT_ONEAUTH="~/.one/one_auth"
+
+    LOCK_POLL_INTERVAL=0.1
+
+    def __init__(self, directory, max_age, lock_timeout):
+        self.directory = directory
+        self.max_age = max_age
+        self.lock_timeout = lock_timeout
+        # one snapshot per endpoint and credentials, as they define what is visible
+        identity = "{0}|{1}".format(os.environ.get(OpenNebula.ENV_ONEXMLRPC), self.auth_digest())
+        self.key = hashlib.sha1(identity.encode()).hexdigest()[:16]
+
+    @classmethod
+    def auth_digest(cls):
+        # ONE_AUTH is the path of the credentials file, whose content changes with `oneuser login`
+        path = os.path.expanduser(os.environ.get(cls.ENV_ONEAUTH) or cls.DEFAULT_ONEAUTH)
+        try:
+            with open(path, "rb") as fileobj:
+                return hashlib.sha1(fileobj.read()).hexdigest()
+        except OSError:
+            return None
+
+    @staticmethod
+    def default_directory():
+        base = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+        return os.path.join(base, "opm-{0}".format(os.getuid()))
+
+    def path(self, name, extension):
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+        return os.path.join(self.directory, "{0}-{1}.{2}".format(self.key, name, extension))
+
+    def ensure_directory(self):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        # the directory may have been created beforehand by someone else, eg in a shared /tmp
+        info = os.lstat(self.directory)
+        if not stat.S_ISDIR(info.st_mode):
+            raise Exception("Snapshot directory {0} is not a directory".format(self.directory))
+        if info.st_uid != os.getuid():
+            raise Exception("Snapshot directory {0} is owned by uid {1}, refusing to use it".format(self.directory, info.st_uid))
+        if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise Exception("Snapshot directory {0} is writable by group or others (mode {1:o}), refusing to use it".format(self.directory, stat.S_IMODE(info.st_mode)))
+
+    @contextlib.contextmanager
+    def lock(self, name, timeout=None):
+        # yields whether the lock was acquired, which is always the case without timeout
+        self.ensure_directory()
+        path = self.path(name, "lock")
+        with open(path, "a") as fileobj:
+            logging.debug("Waiting for lock {0}".format(path))
+            if timeout is None:
+                fcntl.flock(fileobj, fcntl.LOCK_EX)
+            else:
+                deadline = time.monotonic() + timeout
+                acquired = False
+                while not acquired:
+                    try:
+                        fcntl.flock(fileobj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        acquired = True
+                    except BlockingIOError:
+                        if time.monotonic() > deadline:
+                            break
+                        time.sleep(self.LOCK_POLL_INTERVAL)
+                if not acquired:
+                    logging.warning("Could not acquire lock {0} within {1}s".format(path, timeout))
+                    yield False
+                    return
+            logging.debug("Acquired lock {0}".format(path))
+            try:
+                yield True
+            finally:
+                fcntl.flock(fileobj, fcntl.LOCK_UN)
+                logging.debug("Released lock {0}".format(path))
+
+    def platform_lock(self, platform_name):
+        # writers must never overlap, so no timeout here
+        return self.lock("platform-{0}".format(platform_name))
+
+    def read(self, name):
+        try:
+            with open(self.path(name, "json")) as fileobj:
+                content = json.load(fileobj)
+        except (OSError, ValueError):
+            return None
+        age = time.time() - content['timestamp']
+        if age < 0 or age > self.max_age:
+            logging.debug("Snapshot {0} is {1:.1f}s old, ignoring it".format(name, age))
+            return None
+        logging.info("Reusing snapshot {0} fetched {1:.1f}s ago".format(name, age))
+        return content['data']
+
+    def write(self, name, data):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "w") as fileobj:
+            json.dump({'timestamp': time.time(), 'data': data}, fileobj)
+        os.replace(temp_path, self.path(name, "json"))
+
+    def fetch(self, name, fetcher, fresh=False):
+        # without reuse, readers have nothing to wait for nor to share
+        if not fresh and self.max_age <= 0:
+            return fetcher()
+        # concurrent callers wait here while the first one fetches
+        with self.lock(name, self.lock_timeout) as acquired:
+            if not acquired:
+                logging.warning("Snapshot {0} is busy, fetching without it".format(name))
+                return fetcher()
+            if not fresh:
+                data = self.read(name)
+                if data is not None:
+                    return data
+            data = fetcher()
+            self.write(name, data)
+            return data
+
+    def invalidate(self, name):
+        # removal is atomic, so it is done even if a stuck fetcher holds the lock
+        with self.lock(name, self.lock_timeout):
+            try:
+                os.remove(self.path(name, "json"))
+            except FileNotFoundError:
+                pass
+
+
 class OpenNebula:
 
     ENV_ONEXMLRPC="ONE_XMLRPC"
 
     ONE_COMMANDS=["oneuser", "onevm", "onetemplate"]
 
+    # see https://docs.opennebula.org/5.4/operation/references/vm_states.html
+    STATE_ACTIVE=3
+    STATE_POWEROFF=8
+    STATES_RESIZABLE=[2, 4, 5, 8, 9]
+    STATES_FAILED=[6, 7]
+    LCM_STATE_RUNNING=3
+    # *_FAILURE lcm states of an ACTIVE vm
+    LCM_STATES_FAILED=[36, 37, 38, 39, 40, 41, 42, 44, 46, 47, 48, 49, 50, 61]
+
     @staticmethod
     def command_implicit_enter(name, *args):
         command = [name, *args]
@@ -348,9 +509,14 @@ class OpenNebula:
                 raise Exception("Error while running command (reason : {0})".format(command, e))
             logging.debug("Command '{0}' found, returned {1}".format(command, result.returncode))
 
-    def set_user_info(self):
+    def cached_command(self, snapshot_name, fresh, name, *args):
+        if self.snapshot is None:
+            return self.command(name, *args)
+        return self.snapshot.fetch(snapshot_name, lambda: self.command(name, *args), fresh)
+
+    def set_user_info(self, fresh=False):
         try:
-            result = self.command("oneuser", "show", "--xml")
+            result = self.cached_command("user", fresh, "oneuser", "show", "--xml")
         except Exception as e:
             raise Exception("Error while running command, try to log in using `oneuser login your_user_name --force` first (reason : {0})".format(e))
         root = ElementTree.fromstring(result)
@@ -373,10 +539,10 @@ class OpenNebula:
         except Exception as e:
             raise Exception("Error while running command (reason : {0})".format(e))
 
-    def vm_list(self):
+    def vm_list(self, fresh=False):
         vms = {}
         try:
-            result = self.command("onevm", "list", "--xml")
+            result = self.cached_command("vms", fresh, "onevm", "list", "--xml")
         except Exception as e:
             raise Exception("Error while running command (reason : {0})".format(e))
         root = ElementTree.fromstring(result)
@@ -387,6 +553,28 @@ class OpenNebula:
         # logging.debug("VM list: {0}".format(vms))
         return vms
 
+    def vm_pool_columns(self, fresh=False):
+        # one list per attribute instead of one VmInfo per vm, for fleet-wide computations
+        columns = { 'name': [], 'id': [], 'state': [], 'group': [], 'cpu': [], 'vcpu': [], 'mem_mb': [] }
+        try:
+            result = self.cached_command("vms", fresh, "onevm", "list", "--xml")
+        except Exception as e:
+            raise Exception("Error while running command (reason : {0})".format(e))
+        root = ElementTree.fromstring(result)
+        for vm_elem in root.iterfind("VM"):
+            columns['name'].append(vm_elem.findtext("NAME"))
+            columns['id'].append(int(vm_elem.findtext("ID")))
+            columns['state'].append(int(vm_elem.findtext("STATE")))
+            columns['group'].append(vm_elem.findtext("GNAME"))
+            value = vm_elem.findtext("TEMPLATE/CPU")
+            columns['cpu'].append(float(value) if value is not None else None)
+            value = vm_elem.findtext("TEMPLATE/VCPU")
+            columns['vcpu'].append(int(value) if value is not None else 1)
+            value = vm_elem.findtext("TEMPLATE/MEMORY")
+            columns['mem_mb'].append(int(value) if value is not None else None)
+        logging.debug("Pool columns for {0} VM".format(len(columns['name'])))
+        return columns
+
     def vm_create(self, vm_info):
         logging.debug("Creating vm: {0}".format(vm_info))
         args = ["--name", vm_info.name,
@@ -450,8 +638,8 @@ class OpenNebula:
         if len(args) == 0:
             logging.info("No difference in vcpu/cpu/mem detected, not resizing VM {0}".format(vm_info.id))
             return
-        # enforce state requirements, see https://docs.opennebula.org/5.4/operation/references/vm_states.html
-        if vm_info.state not in [2, 4, 5, 8, 9]:
+        # enforce state requirements
+        if vm_info.state not in self.STATES_RESIZABLE:
             raise Exception("VM {0} is in a state ({1}) where its envelope cannot be modified".format(vm_info.id, vm_info.state))
         # actual resize operation
         try:
@@ -460,6 +648,76 @@ class OpenNebula:
             raise Exception("Error while running command (reason : {0})".format(e))
         logging.info("Resizing VM {0} done".format(vm_info.id))
 
+    def vm_poweroff(self, vm_infos):
+        vm_ids = ",".join([ str(x.id) for x in vm_infos ])
+        logging.debug("Powering off vms : {0}".format(vm_ids))
+        try:
+            result = self.command("onevm", "poweroff", vm_ids)
+        except Exception as e:
+            raise Exception("Error while running command (reason : {0})".format(e))
+
+    def vm_resume(self, vm_infos):
+        vm_ids = ",".join([ str(x.id) for x in vm_infos ])
+        logging.debug("Resuming vms : {0}".format(vm_ids))
+        try:
+            result = self.command("onevm", "resume", vm_ids)
+        except Exception as e:
+            raise Exception("Error while running command (reason : {0})".format(e))
+
+    def vm_states(self):
+        # polling only needs states, and always bypasses the shared snapshot
+        states = {}
+        try:
+            result = self.command("onevm", "list", "--xml")
+        except Exception as e:
+            raise Exception("Error while running command (reason : {0})".format(e))
+        root = ElementTree.fromstring(result)
+        for vm_elem in root.iterfind("VM"):
+            value = vm_elem.findtext("LCM_STATE")
+            states[int(vm_elem.findtext("ID"))] = (int(vm_elem.findtext("STATE")), int(value) if value is not None else None)
+        return states
+
+    def vm_resume_powered_off(self, vm_infos, interval, timeout):
+        # poweroff may have partially succeeded, so look at the actual states with a single pool request
+        states = self.vm_states()
+        stopped = []
+        for vm_info in vm_infos:
+            if vm_info.id in states:
+                vm_info.state, vm_info.lcm_state = states[vm_info.id]
+            if vm_info.state == self.STATE_POWEROFF:
+                stopped.append(vm_info)
+        if len(stopped) == 0:
+            return
+        self.vm_resume(stopped)
+        # ACTIVE is reached while still booting, only RUNNING means the vm is back
+        self.vm_wait_state(stopped, self.STATE_ACTIVE, interval, timeout, lcm_state=self.LCM_STATE_RUNNING)
+
+    def vm_wait_state(self, vm_infos, state, interval, timeout, lcm_state=None, failed_lcm_states=None):
+        failed_lcm_states = self.LCM_STATES_FAILED + (failed_lcm_states or [])
+        pending = { x.id: x for x in vm_infos }
+        deadline = time.monotonic() + timeout
+        while True:
+            # a single pool request per poll, whatever the number of vms
+            states = self.vm_states()
+            for vm_id in list(pending.keys()):
+                if vm_id not in states:
+                    raise Exception("VM {0} disappeared while waiting for state {1}".format(vm_id, state))
+                current, current_lcm = states[vm_id]
+                pending[vm_id].state = current
+                pending[vm_id].lcm_state = current_lcm
+                if current == state and (lcm_state is None or current_lcm == lcm_state):
+                    del pending[vm_id]
+                elif current in self.STATES_FAILED:
+                    raise Exception("VM {0} entered state {1} while waiting for state {2}".format(vm_id, current, state))
+                elif current == self.STATE_ACTIVE and current_lcm in failed_lcm_states:
+                    raise Exception("VM {0} entered lcm state {1} while waiting for state {2}".format(vm_id, current_lcm, state))
+            if len(pending) == 0:
+                return
+            if time.monotonic() > deadline:
+                raise Exception("Timeout while waiting for VM {0} to reach state {1}".format(", ".join([ str(x) for x in sorted(pending.keys()) ]), state))
+            logging.debug("Waiting for VM {0} to reach state {1}".format(", ".join([ str(x) for x in sorted(pending.keys()) ]), state))
+            time.sleep(interval)
+
     def vm_synchronize(self, vm_info, differences):
         logging.debug("Synchronizing vm : {0}".format(vm_info))
         # group
@@ -524,18 +782,152 @@ class OpenNebula:
         if networks is not None:
             logging.warning("Changing network topology could break the network configuration of the guest (lose mac/ip leases, change interface names) so this function is not implemented and modifications should be done by hand")
 
-    def __init__(self):
-        pass
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot
+
+
+class RecordWriter:
+
+    FIELDS=["platform", "action", "name", "id", "state", "status", "drift", "config"]
+
+    @staticmethod
+    def create(output, stream, fields=None, kind="vm"):
+        if output == "json":
+            return JsonWriter(stream, fields, kind)
+        if output == "jsonl":
+            return JsonlWriter(stream, fields, kind)
+        if output == "csv":
+            return CsvWriter(stream, fields, kind)
+        return None
+
+    @staticmethod
+    def json_default(obj):
+        if isinstance(obj, VmDisk):
+            return obj.to_arg()
+        raise TypeError("Object of type {0} is not serializable".format(obj.__class__.__name__))
+
+    def __init__(self, stream, fields=None, kind="vm"):
+        self.stream = stream
+        # fields and kind of the records, per-vm ones unless told otherwise
+        self.fields = fields or self.FIELDS
+        self.kind = kind
+        self.counts = {'status': {}, 'state': {}, 'drift': {}}
+        self.seen = set()
+
+    def dumps(self, value):
+        return json.dumps(value, default=self.json_default)
+
+    def count(self, category, key):
+        key = str(key)
+        self.counts[category][key] = self.counts[category].get(key, 0) + 1
+
+    def write(self, record):
+        # every record counts for its status, but state and drift are counted once per vm,
+        # from its first record, ie as found before any operation
+        self.count('status', record['status'])
+        vm_key = (record['platform'], record['name'])
+        if vm_key not in self.seen:
+            self.seen.add(vm_key)
+            if record['state'] is not None:
+                self.count('state', record['state'])
+            if record['drift'] is not None:
+                for key in record['drift']:
+                    self.count('drift', key)
+        self.write_record(record)
+
+    def close(self, summary=None):
+        # per-vm counts, unless the caller computed its own summary
+        self.write_summary(summary if summary is not None else self.counts)
+        self.stream.flush()
+
+
+class JsonWriter(RecordWriter):
+
+    def __init__(self, stream, fields=None, kind="vm"):
+        super().__init__(stream, fields, kind)
+        self.first = True
+        self.stream.write('{"records": [')
+
+    def write_record(self, record):
+        if not self.first:
+            self.stream.write(",")
+        self.first = False
+        self.stream.write("\n")
+        self.stream.write(self.dumps(record))
+
+    def write_summary(self, summary):
+        self.stream.write('\n], "summary": {0}}}\n'.format(self.dumps(summary)))
+
+
+class JsonlWriter(RecordWriter):
+
+    def write_record(self, record):
+        self.stream.write(self.dumps(record))
+        self.stream.write("\n")
+
+    def write_summary(self, summary):
+        self.stream.write(self.dumps({'summary': summary}))
+        self.stream.write("\n")
+
+
+class CsvWriter(RecordWriter):
+
+    def __init__(self, stream, fields=None, kind="vm"):
+        super().__init__(stream, fields, kind)
+        self.writer = csv.writer(stream)
+        self.writer.writerow(["record", *self.fields, "count"])
+
+    def write_record(self, record):
+        row = [self.kind]
+        for field in self.fields:
+            value = record[field]
+            if value is None:
+                value = ""
+            elif isinstance(value, (dict, list)):
+                value = self.dumps(value)
+            row.append(value)
+        row.append("")
+        self.writer.writerow(row)
+
+    def write_summary(self, summary):
+        # summary rows hold "category:key" (eg "drift:mem_mb"), or "category" for flat summaries,
+        # in the name column, or the first one when there is no name
+        label = self.fields.index("name") if "name" in self.fields else 0
+        for category, counts in summary.items():
+            if not isinstance(counts, dict):
+                counts = { None: counts }
+            for key, count in sorted(counts.items(), key=lambda x: str(x[0])):
+                row = ["summary"] + [""] * len(self.fields) + [count]
+                row[1 + label] = category if key is None else "{0}:{1}".format(category, key)
+                self.writer.writerow(row)
 
 
 class App:
 
+    ORPHAN_CLASS="(orphan)"
+
+    MUTATING_ACTIONS=["create-missing", "synchronize", "delete-unreferenced", "delete-all"]
+
+    # compared field, VmInfo attribute and pool column
+    RESOURCE_FIELDS=[("cpu_percent", "cpu"), ("vcpu_count", "vcpu"), ("mem_mb", "mem_mb")]
+
+    DRIFT_REPORT_FIELDS=[
+        "platform", "class", "vms", "missing", "orphans",
+        "cpu_percent", "vcpu_count", "mem_mb",
+        "drift_group", "drift_cpu_percent", "drift_vcpu_count", "drift_mem_mb",
+        "cpu_percent_over", "cpu_percent_under",
+        "vcpu_count_over", "vcpu_count_under",
+        "mem_mb_over", "mem_mb_under"]
+
     def __init__(self, args):
         self.args = args
         self.setup_logging()
         self.target = {}
         self.existing = {}
-        self.one = OpenNebula()
+        self.rolling = []
+        self.output = None
+        self.snapshot = Snapshot(args.snapshot_dir, args.snapshot_max_age, args.snapshot_lock_timeout)
+        self.one = OpenNebula(self.snapshot)
 
     def setup_logging(self):
         # root logger
@@ -582,6 +974,10 @@ class App:
             # initialize vm data
             vm = VmInfo()
             vm.name = "{0}-{1}".format(self.platform_name, vm_name)
+            try:
+                vm.vm_class = vm_host_def['class']
+            except KeyError:
+                vm.vm_class = None
             # load default configuration
             try:
                 defaults = jdata['defaults']
@@ -608,9 +1004,14 @@ class App:
     def create(self, vm_name):
         logging.info("VM {0} does not exist, creating it".format(vm_name))
         vm = self.target[vm_name]
-        self.one.vm_create(vm)
+        self.report(None, vm, "planned")
+        try:
+            self.one.vm_create(vm)
+        except Exception:
+            self.report(None, vm, "failed")
+            raise
         logging.debug("Created VM with ID {0}".format(vm.id))
-        print("{0}: created ID {1}".format(vm.name, vm.id))
+        self.report(lambda: "{0}: created ID {1}".format(vm.name, vm.id), vm, "created")
 
     def synchronize(self, vm_name):
         logging.info("Synchronizing VM {0}".format(vm_name))
@@ -619,23 +1020,122 @@ class App:
         if current.name != target.name:
             raise Exception("Both VM do not refer to the same host")
         differences = current.compare_config(target)
-        if len(differences) > 0:
-            delta = ", ".join([
+        if len(differences) == 0:
+            self.report(None, current, "unchanged", drift={})
+        else:
+            self.report(lambda: "{0}: ID {1}, {2}".format(vm_name, current.id, ", ".join([
                 "changing {0} from {1} to {2}".format(key, change[0], change[1])
                 for key, change in differences.items()
-                ])
-            print("{0}: ID {1}, {2}".format(vm_name, current.id, delta))
-            self.one.vm_synchronize(current, differences)
+                ])), current, "planned", drift=differences)
+            # running vms are resized later, in batches, when allowed to ; any other state keeps failing in vm_resize
+            if self.args.rolling_resize and current.state == OpenNebula.STATE_ACTIVE and current.lcm_state == OpenNebula.LCM_STATE_RUNNING:
+                sizes = {
+                    key: differences.pop(key)[1] for key in ["cpu_percent", "vcpu_count", "mem_mb"]
+                    if key in differences
+                }
+                if len(sizes) > 0:
+                    logging.info("VM {0} is in state {1}, queuing it for rolling resize".format(vm_name, current.state))
+                    self.rolling.append((current, target.vm_class, sizes))
+                    self.report(None, current, "queued")
+            if len(differences) == 0:
+                return
+            try:
+                self.one.vm_synchronize(current, differences)
+            except Exception:
+                self.report(None, current, "failed")
+                raise
+            self.report(None, current, "synchronized")
+
+    def plan_rolling_batches(self):
+        batches = []
+        queue = list(self.rolling)
+        while len(queue) > 0:
+            batch = []
+            per_class = {}
+            deferred = []
+            for item in queue:
+                vm_class = item[1]
+                if len(batch) < self.args.batch_size and per_class.get(vm_class, 0) < self.args.max_unavailable:
+                    batch.append(item)
+                    per_class[vm_class] = per_class.get(vm_class, 0) + 1
+                else:
+                    deferred.append(item)
+            batches.append(batch)
+            queue = deferred
+        return batches
+
+    def rolling_resize(self):
+        batches = self.plan_rolling_batches()
+        for number, batch in enumerate(batches, 1):
+            vms = [ item[0] for item in batch ]
+            logging.info("Rolling resize batch {0}/{1} : {2}".format(number, len(batches), ", ".join([ x.name for x in vms ])))
+            resized = []
+            failure = None
+            try:
+                self.one.vm_poweroff(vms)
+                # oned leaves RUNNING as soon as poweroff is accepted, so RUNNING again means the shutdown failed
+                self.one.vm_wait_state(vms, OpenNebula.STATE_POWEROFF, self.args.poll_interval, self.args.poll_timeout, failed_lcm_states=[OpenNebula.LCM_STATE_RUNNING])
+                for vm, vm_class, sizes in batch:
+                    self.one.vm_resize(vm, **sizes)
+                    vm.cpu = sizes.get('cpu_percent', vm.cpu)
+                    vm.vcpu = sizes.get('vcpu_count', vm.vcpu)
+                    vm.mem_mb = sizes.get('mem_mb', vm.mem_mb)
+                    resized.append(vm)
+                    self.report(lambda: "{0}: ID {1}, resized offline".format(vm.name, vm.id), vm, "resized")
+            except Exception as e:
+                failure = e
+            finally:
+                # always bring back whatever reached poweroff, whichever step failed
+                try:
+                    self.one.vm_resume_powered_off(vms, self.args.poll_interval, self.args.poll_timeout)
+                except Exception as e:
+                    if failure is None:
+                        failure = e
+                    else:
+                        logging.error("Could not resume batch {0}/{1} after failure (reason : {2})".format(number, len(batches), e))
+            if failure is not None:
+                for vm in vms:
+                    if vm not in resized:
+                        self.report(None, vm, "failed")
+                unresized = [ x.name for x in vms if x not in resized ]
+                remaining = sum([ len(x) for x in batches[number:] ])
+                logging.error("VM of batch {0}/{1} not resized : {2}".format(number, len(batches), ", ".join(unresized)))
+                raise Exception("Rolling resize halted at batch {0}/{1}, {2} VM of this batch not resized, {3} queued VM of later batches left untouched (reason : {4})".format(number, len(batches), len(unresized), remaining, failure))
 
     def destroy(self, vm_name):
         logging.info("Destroying unreferenced VM {0}".format(vm_name))
         vm = self.existing[vm_name]
-        self.one.vm_destroy(vm)
+        self.report(None, vm, "planned")
+        try:
+            self.one.vm_destroy(vm)
+        except Exception:
+            self.report(None, vm, "failed")
+            raise
         logging.debug("Destroyed VM with ID {0}".format(vm.id))
-        print("{0}: destroyed ID {1}".format(vm.name, vm.id))
+        self.report(lambda: "{0}: destroyed ID {1}".format(vm.name, vm.id), vm, "destroyed")
+
+    def record(self, vm, status, drift=None, config=None):
+        return {
+            'platform': self.platform_name,
+            'action': self.args.action,
+            'name': vm.name,
+            'id': vm.id,
+            'state': vm.state,
+            'status': status,
+            'drift': drift,
+            'config': config,
+        }
+
+    def report(self, text, vm, status, drift=None, config=None):
+        # text is only formatted for the default human readable output, and some records have none
+        if self.output is None:
+            if text is not None:
+                print(text())
+        else:
+            self.output.write(self.record(vm, status, drift, config))
 
-    def list(self, platform_name):
-        vms = self.one.vm_list()
+    def list(self, platform_name, fresh=False):
+        vms = self.one.vm_list(fresh)
         # ignoring VM without our prefix
         vms = {
             key:value for key, value in vms.items()
@@ -645,24 +1145,171 @@ class App:
         logging.info("Existing managed VM : {0}".format(", ".join(vms.keys()) if len(vms) > 0 else "None"))
         return vms
 
-    def run_all(self):
-        # parse data file
+    @staticmethod
+    def match_platform(name, platforms):
+        # platforms are sorted longest first, so that prefixes sharing a start resolve correctly
+        for platform_name in platforms:
+            if name.startswith("{0}-".format(platform_name)):
+                return platform_name
+        return None
+
+    def compute_drift(self, definitions, columns):
+        platforms = sorted(set([ x[0] for x in definitions.values() ]), key=len, reverse=True)
+        names = columns['name']
+        # target columns aligned on the pool columns, None for orphans
+        matches = [ definitions.get(name) for name in names ]
+        targets = [ x[1] if x is not None else None for x in matches ]
+        platform_col = [
+            x[0] if x is not None else self.match_platform(name, platforms)
+            for name, x in zip(names, matches)
+        ]
+        # orphans get their own class, so that per-class totals only cover defined hosts
+        class_col = [ t.vm_class if t is not None else self.ORPHAN_CLASS for t in targets ]
+        drift_cols = {
+            'group': [
+                t is not None and g is not None and t.group is not None and g != t.group
+                for g, t in zip(columns['group'], targets)
+            ]
+        }
+        delta_cols = {}
+        for field, attr in self.RESOURCE_FIELDS:
+            target_col = [ getattr(t, attr) if t is not None else None for t in targets ]
+            drift_cols[field] = [
+                t is not None and c != tc
+                for c, tc, t in zip(columns[attr], target_col, targets)
+            ]
+            # positive when over-provisioned, negative when under-provisioned
+            delta_cols[field] = [
+                c - tc if c is not None and tc is not None else 0
+                for c, tc in zip(columns[attr], target_col)
+            ]
+        # aggregate columns by platform and class
+        rows = {}
+        def row(platform_name, vm_class):
+            key = (platform_name, vm_class)
+            if key not in rows:
+                rows[key] = { field: 0 for field in self.DRIFT_REPORT_FIELDS }
+                rows[key]['platform'] = platform_name
+                rows[key]['class'] = vm_class
+            return rows[key]
+        for index, (platform_name, vm_class, target) in enumerate(zip(platform_col, class_col, targets)):
+            current = row(platform_name, vm_class)
+            if target is None:
+                current['orphans'] += 1
+            else:
+                current['vms'] += 1
+            for field, attr in self.RESOURCE_FIELDS:
+                value = columns[attr][index]
+                if value is not None:
+                    current[field] += value
+                delta = delta_cols[field][index]
+                if delta > 0:
+                    current["{0}_over".format(field)] += delta
+                elif delta < 0:
+                    current["{0}_under".format(field)] -= delta
+            for field, drift_col in drift_cols.items():
+                if drift_col[index]:
+                    current["drift_{0}".format(field)] += 1
+        # definitions without vm
+        present = set(names)
+        for name, (platform_name, vm) in definitions.items():
+            if name not in present:
+                row(platform_name, vm.vm_class)['missing'] += 1
+        rows = [ rows[key] for key in sorted(rows.keys(), key=lambda x: (str(x[0]), str(x[1]))) ]
+        totals = { field: 0 for field in self.DRIFT_REPORT_FIELDS[2:] }
+        for current in rows:
+            for field in totals:
+                current[field] = round(current[field], 4)
+                totals[field] += current[field]
+        totals = { field: round(value, 4) for field, value in totals.items() }
+        return rows, totals
+
+    def write_drift_report(self, rows, totals):
+        writer = RecordWriter.create(self.args.output, sys.stdout, self.DRIFT_REPORT_FIELDS, "aggregate")
+        if writer is not None:
+            for current in rows:
+                writer.write_record(current)
+            writer.close(totals)
+        else:
+            for current in [*rows, dict(totals, platform="total", **{'class': None})]:
+                print("{0}{1}: {2} VM, {3} missing, {4} orphan, resources cpu_percent={5} vcpu_count={6} mem_mb={7}, drift group={8} cpu_percent={9} vcpu_count={10} mem_mb={11}, over/under cpu_percent={12}/{13} vcpu_count={14}/{15} mem_mb={16}/{17}".format(
+                    current['platform'] if current['platform'] is not None else "(no platform)",
+                    " class {0}".format(current['class']) if current['class'] is not None else "",
+                    current['vms'],
+                    current['missing'],
+                    current['orphans'],
+                    current['cpu_percent'],
+                    current['vcpu_count'],
+                    current['mem_mb'],
+                    current['drift_group'],
+                    current['drift_cpu_percent'],
+                    current['drift_vcpu_count'],
+                    current['drift_mem_mb'],
+                    current['cpu_percent_over'],
+                    current['cpu_percent_under'],
+                    current['vcpu_count_over'],
+                    current['vcpu_count_under'],
+                    current['mem_mb_over'],
+                    current['mem_mb_under']))
+
+    def drift_report(self):
+        # gather every platform definition before a single pool fetch
+        definitions = {}
         for json_file in self.args.jsonfile:
             logging.info("Processing definition file: {0}".format(json_file))
-            self.target = self.load(json_file)
-            self.run()
+            for name, vm in self.load(json_file).items():
+                definitions[name] = (self.platform_name, vm)
+        OpenNebula.verify_environment()
+        OpenNebula.verify_commands()
+        self.snapshot.ensure_directory()
+        self.one.set_user_info()
+        columns = self.one.vm_pool_columns()
+        rows, totals = self.compute_drift(definitions, columns)
+        self.write_drift_report(rows, totals)
+
+    def run_all(self):
+        # read-only, fleet-wide, with its own output
+        if self.args.action == "drift-report":
+            self.drift_report()
+            return
+        self.output = RecordWriter.create(self.args.output, sys.stdout)
+        try:
+            # parse data file
+            for json_file in self.args.jsonfile:
+                logging.info("Processing definition file: {0}".format(json_file))
+                self.target = self.load(json_file)
+                self.run()
+        finally:
+            if self.output is not None:
+                self.output.close()
 
     def run(self):
         # handle parse-only
         if self.args.action == "parse-only":
             for key in sorted(self.target):
-                print(self.target[key].pretty_tostring())
+                vm = self.target[key]
+                if self.output is None:
+                    print(vm.pretty_tostring())
+                else:
+                    self.output.write(self.record(vm, "defined", config=vm.config_record()))
             return
-        # get existing vm FOR OUR PLATFORM
         OpenNebula.verify_environment()
         OpenNebula.verify_commands()
+        self.snapshot.ensure_directory()
+        if self.args.action not in self.MUTATING_ACTIONS:
+            self.run_action()
+            return
+        # writers work on a fresh pool, one at a time per platform
+        with self.snapshot.platform_lock(self.platform_name):
+            try:
+                self.run_action(fresh=True)
+            finally:
+                self.snapshot.invalidate("vms")
+
+    def run_action(self, fresh=False):
+        # get existing vm FOR OUR PLATFORM
         self.one.set_user_info()
-        self.existing = self.list(self.platform_name)
+        self.existing = self.list(self.platform_name, fresh)
         # compute sets for actions
         current = set(self.existing.keys())
         target = set(self.target.keys())
@@ -671,19 +1318,27 @@ class App:
         unreferenced = current.difference(target)
         if self.args.action == "status":
             for vm_name in sorted(missing):
-                print("{0}: missing".format(self.target[vm_name].name))
+                vm = self.target[vm_name]
+                self.report(lambda: "{0}: missing".format(vm.name), vm, "missing")
             for vm_name in sorted(present):
-                print("{0}: present ID {1}".format(self.existing[vm_name].name, self.existing[vm_name].id))
+                vm = self.existing[vm_name]
+                # drift is only part of machine-readable output
+                drift = vm.compare_config(self.target[vm_name]) if self.output is not None else None
+                self.report(lambda: "{0}: present ID {1}".format(vm.name, vm.id), vm, "present", drift=drift)
             for vm_name in sorted(unreferenced):
-                print("{0}: unreferenced ID {1}".format(self.existing[vm_name].name, self.existing[vm_name].id))
+                vm = self.existing[vm_name]
+                self.report(lambda: "{0}: unreferenced ID {1}".format(vm.name, vm.id), vm, "unreferenced")
         elif self.args.action == "create-missing":
             # create what must be created
             for vm_name in sorted(missing):
                 self.create(vm_name)
         elif self.args.action == "synchronize":
             # synchronize what could differ
+            self.rolling = []
             for vm_name in sorted(present):
                 self.synchronize(vm_name)
+            if len(self.rolling) > 0:
+                self.rolling_resize()
         elif self.args.action == "delete-unreferenced":
             # delete what should not be there
             for vm_name in sorted(unreferenced):
@@ -699,9 +1354,20 @@ def main():
     try:
         parser = argparse.ArgumentParser(description="one-pf-manage")
         parser.add_argument("-l", "--log-level", metavar="LVL", choices=["critical", "error", "warning", "info", "debug"], default="warning")
-        parser.add_argument("action", choices=["status", "create-missing", "synchronize", "delete-unreferenced", "delete-all", "parse-only"], default="status")
+        parser.add_argument("action", choices=["status", "create-missing", "synchronize", "delete-unreferenced", "delete-all", "parse-only", "drift-report"], default="status")
+        parser.add_argument("-o", "--output", choices=["text", "json", "jsonl", "csv"], default="text", help="output format of the per-VM records")
+        parser.add_argument("--rolling-resize", action="store_true", help="synchronize: power off, resize and resume running VM in batches")
+        parser.add_argument("--batch-size", metavar="N", type=int, default=1, help="rolling resize: VM powered off per batch")
+        parser.add_argument("--max-unavailable", metavar="N", type=int, default=1, help="rolling resize: VM of the same class powered off at once")
+        parser.add_argument("--poll-interval", metavar="SEC", type=float, default=5, help="rolling resize: delay between state polls")
+        parser.add_argument("--poll-timeout", metavar="SEC", type=float, default=300, help="rolling resize: maximum wait for a state change")
+        parser.add_argument("--snapshot-dir", metavar="DIR", default=Snapshot.default_directory(), help="directory of the pool snapshot shared by concurrent invocations")
+        parser.add_argument("--snapshot-max-age", metavar="SEC", type=float, default=5, help="reuse a shared pool snapshot younger than this (0 disables reuse)")
+        parser.add_argument("--snapshot-lock-timeout", metavar="SEC", type=float, default=30, help="maximum wait for a concurrent pool fetch before fetching without the snapshot")
         parser.add_argument("jsonfile", nargs='+')
         args = parser.parse_args()
+        if args.batch_size < 1 or args.max_unavailable < 1:
+            parser.error("--batch-size and --max-unavailable must be at least 1")
         app = App(args)
         app.run_all()
         sys.exit(0)